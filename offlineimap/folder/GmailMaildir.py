@@ -21,7 +21,19 @@ from sys import exc_info
 import offlineimap.accounts
 from offlineimap import OfflineImapError
 from offlineimap import imaputil
-from .Maildir import MaildirFolder
+from .Maildir import MaildirFolder, _MsgEntry
+
+
+class _GmailMsgEntry(_MsgEntry):
+    """An element of a GmailMaildir folder's messagelist"""
+
+    __slots__ = ('labels', 'labels_cached', 'mtime')
+
+    def __init__(self, flags, filename):
+        super(_GmailMsgEntry, self).__init__(flags, filename)
+        self.labels = set()
+        self.labels_cached = False
+        self.mtime = 0
 
 
 class GmailMaildirFolder(MaildirFolder):
@@ -52,23 +64,27 @@ class GmailMaildirFolder(MaildirFolder):
 
         self.cachemessagelist()
         # Folder has different uids than statusfolder => TRUE.
-        if sorted(self.getmessageuidlist()) != \
-                sorted(statusfolder.getmessageuidlist()):
+        # Comparing the key views is a set comparison, no need to sort.
+        messagelist = self.getmessagelist()
+        statuslist = statusfolder.getmessagelist()
+        if messagelist.keys() != statuslist.keys():
             return True
         # Check for flag changes, it's quick on a Maildir.
-        for (uid, message) in list(self.getmessagelist().items()):
-            if message['flags'] != statusfolder.getmessageflags(uid):
+        for (uid, message) in messagelist.items():
+            if message.flags != statusfolder.getmessageflags(uid):
                 return True
         # check for newer mtimes. it is also fast
-        for (uid, message) in list(self.getmessagelist().items()):
-            if message['mtime'] > statusfolder.getmessagemtime(uid):
+        for (uid, message) in messagelist.items():
+            if message.mtime > statusfolder.getmessagemtime(uid):
                 return True
         return False  # Nope, nothing changed.
 
     # Interface from BaseFolder
-    def msglist_item_initializer(self, uid):
-        return {'flags': set(), 'labels': set(), 'labels_cached': False,
-                'filename': '/no-dir/no-such-file/', 'mtime': 0}
+    def msglist_item_initializer(self, uid, flags=None,
+                                 filename='/no-dir/no-such-file/'):
+        if flags is None:
+            flags = set()
+        return _GmailMsgEntry(flags, filename)
 
     def cachemessagelist(self, min_date=None, min_uid=None):
         if self.ismessagelistempty():
@@ -78,13 +94,13 @@ class GmailMaildirFolder(MaildirFolder):
         # Get mtimes
         if self.synclabels:
             for uid, msg in list(self.messagelist.items()):
-                filepath = os.path.join(self.getfullname(), msg['filename'])
-                msg['mtime'] = int(os.stat(filepath).st_mtime)
+                filepath = os.path.join(self.getfullname(), msg.filename)
+                msg.mtime = int(os.stat(filepath).st_mtime)
 
     def getmessagelabels(self, uid):
         # Labels are not cached in cachemessagelist because it is too slow.
-        if not self.messagelist[uid]['labels_cached']:
-            filename = self.messagelist[uid]['filename']
+        if not self.messagelist[uid].labels_cached:
+            filename = self.messagelist[uid].filename
             filepath = os.path.join(self.getfullname(), filename)
 
             if not os.path.exists(filepath):
@@ -94,19 +110,16 @@ class GmailMaildirFolder(MaildirFolder):
             msg = self.parser['8bit'].parse(fd)
             fd.close()
 
-            self.messagelist[uid]['labels'] = set()
+            self.messagelist[uid].labels = set()
             for hstr in self.getmessageheaderlist(msg, self.labelsheader):
-                self.messagelist[uid]['labels'].update(
+                self.messagelist[uid].labels.update(
                     imaputil.labels_from_header(self.labelsheader, hstr))
-            self.messagelist[uid]['labels_cached'] = True
+            self.messagelist[uid].labels_cached = True
 
-        return self.messagelist[uid]['labels']
+        return self.messagelist[uid].labels
 
     def getmessagemtime(self, uid):
-        if 'mtime' not in self.messagelist[uid]:
-            return 0
-        else:
-            return self.messagelist[uid]['mtime']
+        return self.messagelist[uid].mtime
 
     def savemessage(self, uid, msg, flags, rtime):
         """Writes a new message, with the specified uid.
@@ -128,10 +141,10 @@ class GmailMaildirFolder(MaildirFolder):
                                                           rtime)
 
         # Update the mtime and labels.
-        filename = self.messagelist[uid]['filename']
+        filename = self.messagelist[uid].filename
         filepath = os.path.join(self.getfullname(), filename)
-        self.messagelist[uid]['mtime'] = int(os.stat(filepath).st_mtime)
-        self.messagelist[uid]['labels'] = labels
+        self.messagelist[uid].mtime = int(os.stat(filepath).st_mtime)
+        self.messagelist[uid].labels = labels
         return ret
 
     def savemessagelabels(self, uid, labels, ignorelabels=None):
@@ -143,7 +156,7 @@ class GmailMaildirFolder(MaildirFolder):
         if ignorelabels is None:
             ignorelabels = set()
 
-        filename = self.messagelist[uid]['filename']
+        filename = self.messagelist[uid].filename
         filepath = os.path.join(self.getfullname(), filename)
 
         fd = open(filepath, 'rb')
@@ -192,8 +205,9 @@ class GmailMaildirFolder(MaildirFolder):
             os.utime(filepath, (mtime, mtime))
 
         # save the new mtime and labels
-        self.messagelist[uid]['mtime'] = int(os.stat(filepath).st_mtime)
-        self.messagelist[uid]['labels'] = labels
+        self.messagelist[uid].mtime = int(os.stat(filepath).st_mtime)
+        self.messagelist[uid].time = None  # Let getmessagetime() stat again.
+        self.messagelist[uid].labels = labels
 
     def copymessageto(self, uid, dstfolder, statusfolder, register=1):
         """Copies a message from self to dst if needed, updating the status
@@ -332,7 +346,7 @@ class GmailMaildirFolder(MaildirFolder):
                 if self.repository.account.dryrun:
                     continue  # Don't actually update statusfolder.
 
-                filename = self.messagelist[uid]['filename']
+                filename = self.messagelist[uid].filename
                 filepath = os.path.join(self.getfullname(), filename)
                 mtimes[uid] = int(os.stat(filepath).st_mtime)
 
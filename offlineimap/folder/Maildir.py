@@ -28,13 +28,53 @@ from .Base import BaseFolder
 from email.errors import NoBoundaryInMultipartDefect
 
 # Find the UID in a message filename
-re_uidmatch = re.compile(',U=(\d+)')
+re_uidmatch = re.compile(r',U=(\d+)', re.ASCII)
 # Find a numeric timestamp in a string (filename prefix)
-re_timestampmatch = re.compile('(\d+)')
+re_timestampmatch = re.compile(r'(\d+)', re.ASCII)
 
 timehash = {}
 timelock = Lock()
 
+# The standard Maildir flags, in the order they go into the info string.
+_FLAG_ORDER = 'DFPRST'
+
+# Flag sets parsed from filenames, by info string. Most messages share one
+# of a few combinations, so they can share a frozenset as well.
+_flagsets = {'': frozenset()}
+
+
+def _format_flags(flags):
+    """Return the Maildir flags as info string, i.e. sorted by ASCII value
+
+    Shortcuts sorted() for the usual empty, single flag or standard flags
+    only cases."""
+
+    if len(flags) < 2:
+        return ''.join(flags)
+    standard = [c for c in _FLAG_ORDER if c in flags]
+    if len(standard) == len(flags):
+        return ''.join(standard)
+    return ''.join(sorted(flags))
+
+
+class _MsgEntry:
+    """An element of a Maildir folder's messagelist
+
+    Maildirs can hold a lot of messages, and a slotted object takes a
+    fraction of the memory of a dict."""
+
+    __slots__ = ('flags', 'filename', 'time')
+
+    def __init__(self, flags, filename):
+        self.flags = flags
+        self.filename = filename
+        # The file's mtime, as returned by getmessagetime(), if known.
+        self.time = None
+
+
+# Whether we can rename/unlink messages relative to an open folder directory.
+_have_dir_fd = {os.open, os.rename, os.unlink} <= os.supports_dir_fd
+
 
 def _gettimeseq(date=None):
     global timehash, timelock
@@ -61,14 +101,22 @@ class MaildirFolder(BaseFolder):
             "Account " + self.accountname, "maildir-windows-compatible", False)
         self.infosep = '!' if self.wincompatible else ':'
         """infosep is the separator between maildir name and flag appendix"""
-        self.re_flagmatch = re.compile('%s2,(\w*)' % self.infosep)
+        self.re_flagmatch = re.compile(r'%s2,(\w*)' % self.infosep, re.ASCII)
         # self.ui is set in BaseFolder.init()
-        # Everything up to the first comma or colon (or ! if Windows):
-        self.re_prefixmatch = re.compile('([^' + self.infosep + ',]*)')
         # folder's md, so we can match with recorded file md5 for validity.
         self._foldermd5 = md5(self.getvisiblename().encode('utf-8')).hexdigest()
+        # The FMD5 part of the filenames of messages that belong to us.
+        self._fmd5_marker = ',FMD5=' + self._foldermd5
         # Cache the full folder path, as we use getfullname() very often.
         self._fullname = os.path.join(self.getroot(), self.getname())
+        # Message paths are always simple 'cur/...', 'new/...' or 'tmp/...'
+        # names, so we can just glue them onto this instead of using
+        # os.path.join().
+        self._fullname_prefix = self._fullname + os.path.sep
+        # File descriptor of the folder directory, see _getrootfd().
+        self._root_fd = None
+        # Messages may be saved from several copy threads at once.
+        self._root_fd_lock = Lock()
         # Modification time from 'Date' header.
         utime_from_header_global = self.config.getdefaultboolean(
             "general", "utime_from_header", False)
@@ -84,6 +132,52 @@ class MaildirFolder(BaseFolder):
         """Return the absolute file path to the Maildir folder (sans cur|new)"""
         return self._fullname
 
+    def _getrootfd(self):
+        """Return a file descriptor for the folder directory, or None
+
+        Messages are renamed and unlinked relative to this descriptor, which
+        spares the kernel from walking the full path for every operation.
+        It is opened on first use and closed by dropmessagelistcache().
+        Returns None if the platform does not support dir_fd."""
+
+        if self._root_fd is None and _have_dir_fd:
+            with self._root_fd_lock:
+                if self._root_fd is None:
+                    self._root_fd = os.open(self._fullname,
+                                            os.O_RDONLY | os.O_DIRECTORY)
+        return self._root_fd
+
+    def _closerootfd(self):
+        with self._root_fd_lock:
+            if self._root_fd is not None:
+                os.close(self._root_fd)
+                self._root_fd = None
+
+    def _rename(self, oldfilename, newfilename):
+        """Rename a message file, both paths are relative to the folder"""
+
+        root_fd = self._getrootfd()
+        if root_fd is None:
+            os.rename(self._fullname_prefix + oldfilename,
+                      self._fullname_prefix + newfilename)
+        else:
+            os.rename(oldfilename, newfilename,
+                      src_dir_fd=root_fd, dst_dir_fd=root_fd)
+
+    def _unlink(self, filename):
+        """Unlink a message file, the path is relative to the folder"""
+
+        root_fd = self._getrootfd()
+        if root_fd is None:
+            os.unlink(self._fullname_prefix + filename)
+        else:
+            os.unlink(filename, dir_fd=root_fd)
+
+    def __del__(self):
+        # __init__ may not have gotten far enough to set _root_fd.
+        if getattr(self, '_root_fd', None) is not None:
+            self._closerootfd()
+
     # Interface from BaseFolder
     def get_uidvalidity(self):
         """Retrieve the current connections UIDVALIDITY value
@@ -92,17 +186,22 @@ class MaildirFolder(BaseFolder):
         token."""
         return 42
 
-    def _iswithintime(self, messagename, date):
-        """Check to see if the given message is newer than date (a
-        time_struct) according to the maildir name which should begin
-        with a timestamp."""
-
-        timestampmatch = re_timestampmatch.search(messagename)
-        if not timestampmatch:
-            return True
-        timestampstr = timestampmatch.group()
+    def _iswithintime(self, messagename, min_epoch):
+        """Check to see if the given message is newer than min_epoch
+        (seconds since the epoch, as returned by time.mktime()) according
+        to the maildir name which should begin with a timestamp."""
+
+        # Maildir names start with '<time>.' or, for the ones we create,
+        # '<time>_<seq>.', so try slicing off the timestamp before resorting
+        # to the regex.
+        timestampstr = messagename.partition('.')[0].partition('_')[0]
+        if not timestampstr.isdecimal():
+            timestampmatch = re_timestampmatch.search(messagename)
+            if not timestampmatch:
+                return True
+            timestampstr = timestampmatch.group()
         timestamplong = int(timestampstr)
-        if timestamplong < time.mktime(date):
+        if timestamplong < min_epoch:
             return False
         else:
             return True
@@ -121,15 +220,20 @@ class MaildirFolder(BaseFolder):
         detected, we return an empty flags list.
 
         :returns: (prefix, UID, FMD5, flags). UID is a numeric "long"
-            type. flags is a set() of Maildir flags.
+            type. flags is a frozenset() of Maildir flags, shared with
+            other messages that have the same flags.
         """
 
-        prefix, uid, fmd5, flags = None, None, None, set()
-        prefixmatch = self.re_prefixmatch.match(filename)
-        if prefixmatch:
-            prefix = prefixmatch.group(1)
-        folderstr = ',FMD5=%s' % self._foldermd5
-        foldermatch = folderstr in filename
+        prefix, uid, fmd5, flags = None, None, None, _flagsets['']
+        # Everything up to the first comma or infosep is the prefix. Plain
+        # string searches are a lot cheaper than the regex engine here.
+        prefix_end = len(filename)
+        for sep in (self.infosep, ','):
+            idx = filename.find(sep, 0, prefix_end)
+            if idx != -1:
+                prefix_end = idx
+        prefix = filename[:prefix_end]
+        foldermatch = self._fmd5_marker in filename
         # If there was no folder MD5 specified, or if it mismatches,
         # assume it is a foreign (new) message and ret: uid, fmd5 = None, None
 
@@ -139,13 +243,17 @@ class MaildirFolder(BaseFolder):
         # XXX: If UID is missing, I have no idea what FMD5 can do. Should be
         # fixed to None in this case, too.
 
-        if foldermatch:
+        if foldermatch and ',U=' in filename:
             uidmatch = re_uidmatch.search(filename)
             if uidmatch:
                 uid = int(uidmatch.group(1))
-        flagmatch = self.re_flagmatch.search(filename)
-        if flagmatch:
-            flags = set((c for c in flagmatch.group(1)))
+        if self.infosep + '2,' in filename:
+            flagmatch = self.re_flagmatch.search(filename)
+            if flagmatch:
+                flagstr = flagmatch.group(1)
+                flags = _flagsets.get(flagstr)
+                if flags is None:
+                    flags = _flagsets.setdefault(flagstr, frozenset(flagstr))
         return prefix, uid, fmd5, flags
 
     def _scanfolder(self, min_date=None, min_uid=None):
@@ -163,56 +271,73 @@ class MaildirFolder(BaseFolder):
         """
 
         maxsize = self.getmaxsize()
+        min_epoch = None
+        if min_date is not None:
+            min_epoch = time.mktime(min_date)
 
         retval = {}
-        files = []
+        date_excludees = {}
         nouidcounter = -1  # Messages without UIDs get negative UIDs.
         for dirannex in ['new', 'cur']:
-            fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend((dirannex, filename) for
-                         filename in os.listdir(fulldirname))
-
-        date_excludees = {}
-        for dirannex, filename in files:
-            if filename.startswith('.'):
-                continue  # Ignore dot files.
-            # We store just dirannex and filename, ie 'cur/123...'
-            filepath = os.path.join(dirannex, filename)
-            # Check maxsize if this message should be considered.
-            if maxsize and (os.path.getsize(
-                    os.path.join(self.getfullname(), filepath)) > maxsize):
-                continue
-
-            prefix, uid, fmd5, flags = self._parse_filename(filename)
-            if uid is None:  # Assign negative uid to upload it.
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:  # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                if not uidmatch:
-                    uid = nouidcounter
-                    nouidcounter -= 1
-                else:
-                    uid = int(uidmatch.group(1))
-            if min_uid is not None and uid > 0 and uid < min_uid:
-                continue
-            if min_date is not None and not self._iswithintime(filename, min_date):
-                # Keep track of messages outside of the time limit, because they
-                # still might have UID > min(UIDs of within-min_date). We hit
-                # this case for maxage if any message had a known/valid datetime
-                # and was re-uploaded because the UID in the filename got lost
-                # (e.g. local copy/move). On next sync, it was assigned a new
-                # UID from the server and will be included in the SEARCH
-                # condition. So, we must re-include them later in this method
-                # in order to avoid inconsistent lists of messages.
-                date_excludees[uid] = self.msglist_item_initializer(uid)
-                date_excludees[uid]['flags'] = flags
-                date_excludees[uid]['filename'] = filepath
-            else:
-                # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
-                retval[uid] = self.msglist_item_initializer(uid)
-                retval[uid]['flags'] = flags
-                retval[uid]['filename'] = filepath
+            fulldirname = self._fullname_prefix + dirannex
+            subdir_prefix = dirannex + os.path.sep
+            # scandir() hands out the directory entries with their stat data
+            # cached once fetched, so checking maxsize also gets us the mtime
+            # for getmessagetime().
+            with os.scandir(fulldirname) as entries:
+                for entry in entries:
+                    filename = entry.name
+                    # The checks below are ordered cheapest first, so that
+                    # files we skip cost as little as possible.
+                    if filename.startswith('.'):
+                        continue  # Ignore dot files.
+                    withintime = min_epoch is None or \
+                        self._iswithintime(filename, min_epoch)
+                    if not withintime and self._fmd5_marker not in filename:
+                        # Messages outside of the time limit are only ever
+                        # re-included below if they have a UID of ours.
+                        continue
+                    # Check maxsize if this message should be considered.
+                    msgtime = None
+                    if maxsize:
+                        msgstat = entry.stat()
+                        if msgstat.st_size > maxsize:
+                            continue
+                        msgtime = msgstat.st_mtime
+                    # We store just dirannex and filename, ie 'cur/123...'
+                    filepath = subdir_prefix + filename
+
+                    prefix, uid, fmd5, flags = self._parse_filename(filename)
+                    # _parse_filename() only returns a UID if the message comes
+                    # from our folder (FMD5 matches) and has one.
+                    if uid is None:
+                        if not withintime:
+                            continue
+                        # Assign negative uid to upload it.
+                        uid = nouidcounter
+                        nouidcounter -= 1
+                    if min_uid is not None and uid > 0 and uid < min_uid:
+                        continue
+                    if not withintime:
+                        # Keep track of messages outside of the time limit,
+                        # because they still might have UID > min(UIDs of
+                        # within-min_date). We hit this case for maxage if
+                        # any message had a known/valid datetime and was
+                        # re-uploaded because the UID in the filename got
+                        # lost (e.g. local copy/move). On next sync, it was
+                        # assigned a new UID from the server and will be
+                        # included in the SEARCH condition. So, we must
+                        # re-include them later in this method in order to
+                        # avoid inconsistent lists of messages.
+                        date_excludees[uid] = self.msglist_item_initializer(
+                            uid, flags, filepath)
+                        date_excludees[uid].time = msgtime
+                    else:
+                        # 'filename' is 'dirannex/filename', e.g.
+                        # cur/123,U=1,FMD5=1:2,S
+                        retval[uid] = self.msglist_item_initializer(
+                            uid, flags, filepath)
+                        retval[uid].time = msgtime
         if min_date is not None:
             # Re-include messages with high enough uid's.
             positive_uids = [uid for uid in retval if uid > 0]
@@ -232,18 +357,36 @@ class MaildirFolder(BaseFolder):
 
         Assumes cachemessagelist() has already been called """
         # Folder has different uids than statusfolder => TRUE.
-        if sorted(self.getmessageuidlist()) != \
-                sorted(statusfolder.getmessageuidlist()):
+        # Comparing the key views is a set comparison, no need to sort.
+        messagelist = self.getmessagelist()
+        statuslist = statusfolder.getmessagelist()
+        if messagelist.keys() != statuslist.keys():
             return True
         # Also check for flag changes, it's quick on a Maildir.
-        for (uid, message) in list(self.getmessagelist().items()):
-            if message['flags'] != statusfolder.getmessageflags(uid):
+        for (uid, message) in messagelist.items():
+            if message.flags != statusfolder.getmessageflags(uid):
                 return True
         return False  # Nope, nothing changed.
 
     # Interface from BaseFolder
-    def msglist_item_initializer(self, uid):
-        return {'flags': set(), 'filename': '/no-dir/no-such-file/'}
+    def msglist_item_initializer(self, uid, flags=None,
+                                 filename='/no-dir/no-such-file/'):
+        """Returns value for a new messagelist element with given UID.
+
+        Unlike the BaseFolder version, this optionally takes the flags and
+        filename of the message, saving callers from overwriting the
+        defaults right away.
+
+        :returns: a _MsgEntry"""
+
+        if flags is None:
+            flags = set()
+        return _MsgEntry(flags, filename)
+
+    # Interface from BaseFolder
+    def dropmessagelistcache(self):
+        super(MaildirFolder, self).dropmessagelistcache()
+        self._closerootfd()
 
     # Interface from BaseFolder
     def cachemessagelist(self, min_date=None, min_uid=None):
@@ -257,8 +400,8 @@ class MaildirFolder(BaseFolder):
     def getmessage(self, uid):
         """Returns an email message object."""
 
-        filename = self.messagelist[uid]['filename']
-        filepath = os.path.join(self.getfullname(), filename)
+        filename = self.messagelist[uid].filename
+        filepath = self._fullname_prefix + filename
         fd = open(filepath, 'rb')
         _fd_bytes = fd.read()
         fd.close()
@@ -294,9 +437,12 @@ class MaildirFolder(BaseFolder):
 
     # Interface from BaseFolder
     def getmessagetime(self, uid):
-        filename = self.messagelist[uid]['filename']
-        filepath = os.path.join(self.getfullname(), filename)
-        return os.path.getmtime(filepath)
+        message = self.messagelist[uid]
+        # _scanfolder() only knows the mtime if it had to stat the file.
+        if message.time is None:
+            message.time = os.path.getmtime(self._fullname_prefix +
+                                            message.filename)
+        return message.time
 
     def new_message_filename(self, uid, flags=None, date=None):
         """Creates a new unique Maildir filename
@@ -312,15 +458,31 @@ class MaildirFolder(BaseFolder):
         timeval, timeseq = _gettimeseq(date)
         uniq_name = '%d_%d.%d.%s,U=%d,FMD5=%s%s2,%s' % \
                     (timeval, timeseq, os.getpid(), socket.gethostname(),
-                     uid, self._foldermd5, self.infosep, ''.join(sorted(flags)))
+                     uid, self._foldermd5, self.infosep, _format_flags(flags))
         return uniq_name.replace(os.path.sep, self.sep_subst)
 
+    def _regenerate_filename(self, filename):
+        """Return filename with a fresh time sequence number
+
+        :param filename: A name created by new_message_filename()
+        :returns: The new name, or None if filename does not start with
+            the '<time>_<seq>.' prefix we create."""
+
+        timeseq, sep, rest = filename.partition('.')
+        timestr = timeseq.partition('_')[0]
+        if not sep or not timestr.isdecimal():
+            return None
+        timeval, seq = _gettimeseq(int(timestr))
+        return '%d_%d.%s' % (timeval, seq, rest)
+
     def save_to_tmp_file(self, filename, msg, policy=None):
         """Saves given message to the named temporary file in the
         'tmp' subdirectory of $CWD.
 
         Arguments:
-        - filename: name of the temporary file;
+        - filename: name of the temporary file, as created by
+          new_message_filename(); if it is taken, the name gets a new
+          sequence number;
         - msg: Email message object
 
         Returns: relative path to the temporary file
@@ -331,35 +493,37 @@ class MaildirFolder(BaseFolder):
         else:
             output_policy = policy
         tmpname = os.path.join('tmp', filename)
-        # Open file and write it out.
-        # XXX: why do we need to loop 7 times?
-        tries = 7
-        while tries:
-            tries = tries - 1
+        # Open file and write it out. If the name is taken, e.g. by another
+        # process delivering into this Maildir, retry right away with the
+        # next sequence number.
+        tries = 128
+        while True:
             try:
-                fd = os.open(os.path.join(self.getfullname(), tmpname),
+                fd = os.open(self._fullname_prefix + tmpname,
                              os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0o666)
                 break
             except OSError as e:
-                if not hasattr(e, 'EEXIST'):
+                if e.errno != errno.EEXIST:
                     raise
-                if e.errno == errno.EEXIST:
-                    if tries:
-                        time.sleep(0.23)
-                        continue
+                tries -= 1
+                newfilename = None
+                if tries:
+                    newfilename = self._regenerate_filename(filename)
+                if newfilename is None:
                     severity = OfflineImapError.ERROR.MESSAGE
                     raise OfflineImapError(
                         "Unique filename %s already exists." %
                         filename, severity,
                         exc_info()[2])
-                else:
-                    raise
+                filename = newfilename
+                tmpname = os.path.join('tmp', filename)
 
         fd = os.fdopen(fd, 'wb')
         fd.write(msg.as_bytes(policy=output_policy))
-        # Make sure the data hits the disk.
-        fd.flush()
         if self.dofsync():
+            # Make sure the data hits the disk. Without fsync, close() below
+            # flushes our buffer just as well.
+            fd.flush()
             os.fsync(fd)
         fd.close()
 
@@ -412,7 +576,7 @@ class MaildirFolder(BaseFolder):
             try:
                 date = self.get_message_date(msg, 'Date')
                 if date is not None:
-                    os.utime(os.path.join(self.getfullname(), tmpname),
+                    os.utime(self._fullname_prefix + tmpname,
                              (date, date))
             # In case date is wrongly so far into the future as to be > max
             # int32.
@@ -423,9 +587,8 @@ class MaildirFolder(BaseFolder):
                 ui.warn("UID %d has invalid date %s: %s\n"
                         "Not changing file modification time" % (uid, datestr, e))
 
-        self.messagelist[uid] = self.msglist_item_initializer(uid)
-        self.messagelist[uid]['flags'] = flags
-        self.messagelist[uid]['filename'] = tmpname
+        self.messagelist[uid] = self.msglist_item_initializer(uid, flags,
+                                                              tmpname)
         # savemessageflags moves msg to 'cur' or 'new' as appropriate.
         self.savemessageflags(uid, flags)
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
@@ -433,7 +596,7 @@ class MaildirFolder(BaseFolder):
 
     # Interface from BaseFolder
     def getmessageflags(self, uid):
-        return self.messagelist[uid]['flags']
+        return self.messagelist[uid].flags
 
     # Interface from BaseFolder
     def savemessageflags(self, uid, flags):
@@ -448,25 +611,24 @@ class MaildirFolder(BaseFolder):
 
         assert uid in self.messagelist
 
-        oldfilename = self.messagelist[uid]['filename']
+        oldfilename = self.messagelist[uid].filename
         dir_prefix, filename = os.path.split(oldfilename)
         # If a message has been seen, it goes into 'cur'
         dir_prefix = 'cur' if 'S' in flags else 'new'
 
-        if flags != self.messagelist[uid]['flags']:
+        if flags != self.messagelist[uid].flags:
             # Flags have actually changed, construct new filename Strip
             # off existing infostring
             infomatch = self.re_flagmatch.search(filename)
             if infomatch:
                 filename = filename[:-len(infomatch.group())]  # strip off
-            infostr = '%s2,%s' % (self.infosep, ''.join(sorted(flags)))
+            infostr = '%s2,%s' % (self.infosep, _format_flags(flags))
             filename += infostr
 
         newfilename = os.path.join(dir_prefix, filename)
         if newfilename != oldfilename:
             try:
-                os.rename(os.path.join(self.getfullname(), oldfilename),
-                          os.path.join(self.getfullname(), newfilename))
+                self._rename(oldfilename, newfilename)
             except OSError as e:
                 raise OfflineImapError(
                     "Can't rename file '%s' to '%s': %s" %
@@ -474,8 +636,8 @@ class MaildirFolder(BaseFolder):
                     OfflineImapError.ERROR.FOLDER,
                     exc_info()[2])
 
-            self.messagelist[uid]['flags'] = flags
-            self.messagelist[uid]['filename'] = newfilename
+            self.messagelist[uid].flags = flags
+            self.messagelist[uid].filename = newfilename
 
     # Interface from BaseFolder
     def change_message_uid(self, uid, new_uid):
@@ -494,17 +656,16 @@ class MaildirFolder(BaseFolder):
         if uid == new_uid:
             return
 
-        oldfilename = self.messagelist[uid]['filename']
+        oldfilename = self.messagelist[uid].filename
         dir_prefix, filename = os.path.split(oldfilename)
         flags = self.getmessageflags(uid)
         # TODO: we aren't keeping the prefix timestamp so we don't honor the
         # filename_use_mail_timestamp configuration option.
         newfilename = os.path.join(dir_prefix,
                                    self.new_message_filename(new_uid, flags))
-        os.rename(os.path.join(self.getfullname(), oldfilename),
-                  os.path.join(self.getfullname(), newfilename))
+        self._rename(oldfilename, newfilename)
         self.messagelist[new_uid] = self.messagelist[uid]
-        self.messagelist[new_uid]['filename'] = newfilename
+        self.messagelist[new_uid].filename = newfilename
         del self.messagelist[uid]
 
     # Interface from BaseFolder
@@ -516,51 +677,86 @@ class MaildirFolder(BaseFolder):
         :return: Nothing, or an Exception if UID but no corresponding file
                  found.
         """
-        filename = self.messagelist[uid]['filename']
-        filepath = os.path.join(self.getfullname(), filename)
+        filename = self.messagelist[uid].filename
         try:
-            os.unlink(filepath)
+            self._unlink(filename)
         except OSError:
             # Can't find the file -- maybe already deleted?
             newmsglist = self._scanfolder()
             if uid in newmsglist:  # Nope, try new filename.
-                filename = newmsglist[uid]['filename']
-                filepath = os.path.join(self.getfullname(), filename)
-                os.unlink(filepath)
+                filename = newmsglist[uid].filename
+                self._unlink(filename)
             # Yep -- return.
         del (self.messagelist[uid])
 
+    # Interface from BaseFolder
+    def deletemessages(self, uidlist):
+        """Unlinks several message files from the Maildir.
+
+        Like calling deletemessage() for every UID, but files that have
+        gone missing meanwhile are looked up with a single rescan of the
+        folder for the whole batch rather than one rescan each.
+
+        :param uidlist: UIDs of the messages to delete
+        """
+
+        missing = []
+        for uid in uidlist:
+            try:
+                self._unlink(self.messagelist[uid].filename)
+            except OSError:
+                # Can't find the file -- maybe already deleted?
+                missing.append(uid)
+                continue
+            del (self.messagelist[uid])
+        if missing:
+            newmsglist = self._scanfolder()
+            for uid in missing:
+                if uid in newmsglist:  # Nope, try new filename.
+                    self._unlink(newmsglist[uid].filename)
+                # Yep -- go on.
+                del (self.messagelist[uid])
+
     def migratefmd5(self, dryrun=False):
         """Migrate FMD5 hashes from versions prior to 6.3.5
 
         :param dryrun: Run in dry run mode
         :return: None
         """
-        oldfmd5 = md5(self.name).hexdigest()
+        oldfmd5 = md5(self.name.encode('utf-8')).hexdigest()
+        oldmarker = ',FMD5=' + oldfmd5
         msglist = self._scanfolder()
-        for mkey, mvalue in list(msglist.items()):
-            filename = os.path.join(self.getfullname(), mvalue['filename'])
-            match = re.search("FMD5=([a-fA-F0-9]+)", filename)
-            if match is None:
-                self.ui.debug("maildir",
-                              "File `%s' doesn't have an FMD5 assigned"
-                              % filename)
-            elif match.group(1) == oldfmd5:
-                self.ui.info("Migrating file `%s' to FMD5 `%s'"
-                             % (filename, self._foldermd5))
-                if not dryrun:
-                    newfilename = filename.replace(
-                        "FMD5=" + match.group(1), "FMD5=" + self._foldermd5)
-                    try:
-                        os.rename(filename, newfilename)
-                    except OSError as e:
-                        raise OfflineImapError(
-                            "Can't rename file '%s' to '%s': %s" %
-                            (filename, newfilename, e.errno),
-                            OfflineImapError.ERROR.FOLDER,
-                            exc_info()[2])
-
-            elif match.group(1) != self._foldermd5:
-                self.ui.warn(("Inconsistent FMD5 for file `%s':"
-                              " Neither `%s' nor `%s' found")
-                             % (filename, oldfmd5, self._foldermd5))
+        try:
+            for mkey, mvalue in list(msglist.items()):
+                msgfilename = mvalue.filename
+                filename = self._fullname_prefix + msgfilename
+                if oldmarker in msgfilename:
+                    self.ui.info("Migrating file `%s' to FMD5 `%s'"
+                                 % (filename, self._foldermd5))
+                    if not dryrun:
+                        newmsgfilename = msgfilename.replace(oldmarker,
+                                                             self._fmd5_marker)
+                        try:
+                            self._rename(msgfilename, newmsgfilename)
+                        except OSError as e:
+                            raise OfflineImapError(
+                                "Can't rename file '%s' to '%s': %s" %
+                                (filename,
+                                 self._fullname_prefix + newmsgfilename,
+                                 e.errno),
+                                OfflineImapError.ERROR.FOLDER,
+                                exc_info()[2])
+                elif self._fmd5_marker in msgfilename:
+                    continue  # Already up to date.
+                elif ',FMD5=' in msgfilename:
+                    self.ui.warn(("Inconsistent FMD5 for file `%s':"
+                                  " Neither `%s' nor `%s' found")
+                                 % (filename, oldfmd5, self._foldermd5))
+                else:
+                    self.ui.debug("maildir",
+                                  "File `%s' doesn't have an FMD5 assigned"
+                                  % filename)
+        finally:
+            # The folders are not dropped after migrating, release the fd
+            # _rename() opened right away.
+            self._closerootfd()